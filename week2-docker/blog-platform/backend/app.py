@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, session
+from flask import Flask, request, jsonify, session, Response, g, has_request_context
 from flask_cors import CORS
 import psycopg2
 from psycopg2.extras import RealDictCursor
@@ -6,7 +6,10 @@ import redis
 import os
 import hashlib
 import secrets
+import uuid
+import time
 from functools import wraps
+from limiter import AdaptiveLimiter
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'dev-secret-change-in-prod')
@@ -26,10 +29,89 @@ DB_CONFIG = {
 REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
 cache = redis.Redis(host=REDIS_HOST, port=6379, decode_responses=True)
 
+# Write Queue Configuration
+# 'direct' writes comments inside the request; 'queued' appends them to a
+# Redis Stream that worker.py drains into PostgreSQL in batches.
+WRITE_MODE = os.getenv('WRITE_MODE', 'direct')
+COMMENT_STREAM = 'stream:comments'
+COMMENT_GROUP = 'comment-writers'
+COMMENT_DEAD_LETTER = 'stream:comments:dead'
+
+# Load Shedding Configuration
+# Adaptive concurrency limit, requests over it get 503 + Retry-After.
+# Reads are shed first, then writes, critical routes last.
+LIMITER_ENABLED = os.getenv('LIMITER_ENABLED', 'true') == 'true'
+RETRY_AFTER = os.getenv('LIMITER_RETRY_AFTER', '1')
+limiter = AdaptiveLimiter(
+    initial_limit=int(os.getenv('LIMITER_INITIAL_LIMIT', 20)),
+    max_limit=int(os.getenv('LIMITER_MAX_LIMIT', 100)),
+    target_latency=int(os.getenv('LIMITER_TARGET_MS', 250)) / 1000,
+    db_wait_limit=int(os.getenv('LIMITER_DB_WAIT_MS', 100)) / 1000
+)
+
+ROUTE_PRIORITY = {
+    'login': 'critical',
+    'register': 'critical',
+    'logout': 'critical',
+    'get_current_user': 'critical',
+    'create_post': 'write',
+    'add_comment': 'write',
+    'like_post': 'write'
+}
+# Never shed, they must keep answering under overload
+LIMITER_EXEMPT = {'health', 'metrics'}
+
+# Rankings Configuration
+# Sorted sets per ranking ('trending', 'popular') and category, bumped on
+# every view and like. Trending uses forward decay: an event is worth
+# weight * 2^((now - epoch) / half-life), so old activity fades without
+# rescoring. rebuild_rankings() moves the epoch forward.
+VIEW_WEIGHT = 1
+LIKE_WEIGHT = 5
+TRENDING_HALF_LIFE = float(os.getenv('TRENDING_HALF_LIFE_HOURS', 24)) * 3600
+RANKINGS_EPOCH = 'rankings:epoch'
+
+# KEYS: epoch, trending all, popular all[, trending category, popular category]
+# ARGV: post id, trending weight, popular weight, now, half-life
+bump_rankings = cache.register_script("""
+local epoch = tonumber(redis.call('GET', KEYS[1]))
+if not epoch then
+    epoch = tonumber(ARGV[4])
+    redis.call('SET', KEYS[1], ARGV[4])
+end
+local decayed = tonumber(ARGV[2]) * 2 ^ ((tonumber(ARGV[4]) - epoch) / tonumber(ARGV[5]))
+for i = 2, #KEYS, 2 do
+    redis.call('ZINCRBY', KEYS[i], decayed, ARGV[1])
+    redis.call('ZINCRBY', KEYS[i + 1], ARGV[3], ARGV[1])
+end
+return 1
+""")
+
 # Helper Functions
+def mark_db_overload():
+    """Flag the current request as failed by database overload"""
+    if has_request_context():
+        g.limiter_overload = True
+
+class OverloadAwareCursor(RealDictCursor):
+    """RealDictCursor that reports OperationalError (timeouts, dropped connections) to the limiter"""
+    def execute(self, query, vars=None):
+        try:
+            return super().execute(query, vars)
+        except psycopg2.OperationalError:
+            mark_db_overload()
+            raise
+
 def get_db_connection():
-    """Get database connection"""
-    return psycopg2.connect(**DB_CONFIG, cursor_factory=RealDictCursor)
+    """Get database connection, slow or failed connects count as overload"""
+    start = time.monotonic()
+    try:
+        conn = psycopg2.connect(**DB_CONFIG, cursor_factory=OverloadAwareCursor)
+    except psycopg2.OperationalError:
+        mark_db_overload()
+        raise
+    limiter.record_db_wait(time.monotonic() - start)
+    return conn
 
 def hash_password(password):
     """Hash password with salt"""
@@ -53,6 +135,156 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def get_idempotency_key():
+    """Client supplied Idempotency-Key header, or a fresh one"""
+    key = request.headers.get('Idempotency-Key', '').strip()
+    return key[:64] if key else uuid.uuid4().hex
+
+def scoped_idempotency_key(scope, key):
+    """Stored form of a key, so two callers sending the same key do not collide"""
+    return hashlib.sha256(f"{scope}:{key}".encode('utf-8')).hexdigest()
+
+def stream_stats(stream, group):
+    """Length, consumer lag and pending count of a write stream"""
+    stats = {'length': 0, 'lag': 0, 'pending': 0}
+    try:
+        stats['length'] = cache.xlen(stream)
+        for info in cache.xinfo_groups(stream):
+            if info['name'] == group:
+                # 'lag' is only reported by Redis 7+, fall back to length
+                lag = info.get('lag')
+                stats['lag'] = lag if lag is not None else stats['length']
+                stats['pending'] = info['pending']
+    except redis.ResponseError:
+        # Stream or consumer group not created yet
+        pass
+    return stats
+
+def ranking_key(ranking, category=None):
+    """Sorted set holding a ranking, overall or for one category"""
+    return f"{ranking}:category:{category}" if category else f"{ranking}:all"
+
+def post_summary(post):
+    """Fields cached in post:<id> so rankings are served without the DB"""
+    return {
+        'id': post['id'],
+        'title': post['title'],
+        'author': post['author'],
+        # Nullable columns, Redis hashes cannot hold None
+        'category': post['category'] or '',
+        'created_at': post['created_at'].isoformat() if post['created_at'] else ''
+    }
+
+def record_activity(post_id, category, trending, popular, summary=None):
+    """
+    Add to a post's trending and popular scores.
+    Best effort: a Redis error is logged, the hourly rebuild repairs the rankings.
+    """
+    keys = [RANKINGS_EPOCH, ranking_key('trending'), ranking_key('popular')]
+    if category:
+        keys += [ranking_key('trending', category), ranking_key('popular', category)]
+    try:
+        pipe = cache.pipeline(transaction=False)
+        if summary:
+            pipe.hset(f"post:{post_id}", mapping=summary)
+        bump_rankings(keys=keys, args=[post_id, trending, popular, time.time(), TRENDING_HALF_LIFE],
+                      client=pipe)
+        pipe.execute()
+    except redis.RedisError as e:
+        app.logger.warning(f"Rankings update for post {post_id} failed: {e}")
+
+def rebuild_rankings():
+    """
+    Rebuild all rankings from PostgreSQL and move the trending epoch to now.
+    Popular scores come straight from views and likes. Trending scores
+    already in Redis are rescaled to the new epoch; posts missing from it
+    (e.g. after Redis lost its data) get views and likes decayed by post age.
+    Bumps landing while the rebuild runs may be lost.
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT p.id, p.title, p.category, p.views, p.likes, p.created_at,
+               u.username as author
+        FROM posts p
+        JOIN users u ON p.author_id = u.id
+    """)
+    posts = cur.fetchall()
+    cur.close()
+    conn.close()
+    
+    now = time.time()
+    epoch = float(cache.get(RANKINGS_EPOCH) or now)
+    rescale = 2 ** ((epoch - now) / TRENDING_HALF_LIFE)
+    current = dict(cache.zrange(ranking_key('trending'), 0, -1, withscores=True))
+    old_keys = list(cache.scan_iter('trending:*')) + list(cache.scan_iter('popular:*'))
+    
+    # MULTI/EXEC so readers never see a half built ranking
+    pipe = cache.pipeline()
+    if old_keys:
+        pipe.delete(*old_keys)
+    pipe.set(RANKINGS_EPOCH, now)
+    for post in posts:
+        popular = post['views'] * VIEW_WEIGHT + post['likes'] * LIKE_WEIGHT
+        if str(post['id']) in current:
+            trending = current[str(post['id'])] * rescale
+        else:
+            age = max(0, now - post['created_at'].timestamp()) if post['created_at'] else 0
+            trending = popular * 2 ** (-age / TRENDING_HALF_LIFE)
+        
+        pipe.hset(f"post:{post['id']}", mapping=post_summary(post))
+        pipe.zadd(ranking_key('trending'), {post['id']: trending})
+        pipe.zadd(ranking_key('popular'), {post['id']: popular})
+        if post['category']:
+            pipe.zadd(ranking_key('trending', post['category']), {post['id']: trending})
+            pipe.zadd(ranking_key('popular', post['category']), {post['id']: popular})
+    pipe.execute()
+    return len(posts)
+
+def ranked_posts(ranking, category, limit):
+    """Top posts of a ranking, ZREVRANGE + one pipelined HGETALL per post"""
+    top = cache.zrevrange(ranking_key(ranking, category), 0, limit - 1, withscores=True)
+    
+    pipe = cache.pipeline(transaction=False)
+    for post_id, _ in top:
+        pipe.hgetall(f"post:{post_id}")
+    summaries = pipe.execute()
+    
+    posts = []
+    for (post_id, score), summary in zip(top, summaries):
+        # Summary missing until the next view or rebuild
+        if summary:
+            summary['id'] = int(post_id)
+            summary['score'] = round(score, 2)
+            posts.append(summary)
+    return posts
+
+# Load Shedding
+@app.before_request
+def admit_request():
+    """Reject the request with 503 when its priority class is over the limit"""
+    if not LIMITER_ENABLED or request.endpoint in LIMITER_EXEMPT:
+        return None
+    priority = ROUTE_PRIORITY.get(request.endpoint, 'read')
+    if not limiter.acquire(priority):
+        return jsonify({'error': 'Server overloaded, retry later'}), 503, {'Retry-After': RETRY_AFTER}
+    g.limiter_priority = priority
+    g.limiter_start = time.monotonic()
+    return None
+
+@app.teardown_request
+def release_request(exc):
+    """
+    Free the slot and feed latency and overload back into the limiter.
+    Only database overload counts as failure: handlers return 500 for bad
+    input too, and those must not let any client shrink the limit.
+    """
+    start = g.pop('limiter_start', None)
+    if start is None:
+        return
+    failed = g.pop('limiter_overload', False) or isinstance(exc, psycopg2.OperationalError)
+    limiter.release(time.monotonic() - start, failed, g.pop('limiter_priority', 'read'))
+
 # Routes
 @app.route('/api/health', methods=['GET'])
 def health():
@@ -77,6 +309,42 @@ def health():
     except Exception as e:
         return jsonify({'status': 'unhealthy', 'error': str(e)}), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text format metrics"""
+    try:
+        comments = stream_stats(COMMENT_STREAM, COMMENT_GROUP)
+        lines = [
+            '# HELP blog_write_queue_length Comments queued and not yet written',
+            '# TYPE blog_write_queue_length gauge',
+            f'blog_write_queue_length{{stream="comments"}} {comments["length"]}',
+            '# HELP blog_write_queue_lag Entries not yet delivered to the comment writers',
+            '# TYPE blog_write_queue_lag gauge',
+            f'blog_write_queue_lag{{stream="comments"}} {comments["lag"]}',
+            '# HELP blog_write_queue_pending Entries delivered but not yet acknowledged',
+            '# TYPE blog_write_queue_pending gauge',
+            f'blog_write_queue_pending{{stream="comments"}} {comments["pending"]}',
+            '# HELP blog_write_queue_dead_letters Entries moved to the dead-letter stream',
+            '# TYPE blog_write_queue_dead_letters gauge',
+            f'blog_write_queue_dead_letters{{stream="comments"}} {cache.xlen(COMMENT_DEAD_LETTER)}',
+        ]
+        
+        load = limiter.snapshot()
+        lines += [
+            '# HELP blog_concurrency_limit Current adaptive concurrency limit',
+            '# TYPE blog_concurrency_limit gauge',
+            f'blog_concurrency_limit {load["limit"]}',
+            '# HELP blog_requests_in_flight Requests currently admitted',
+            '# TYPE blog_requests_in_flight gauge',
+            f'blog_requests_in_flight {load["in_flight"]}',
+            '# HELP blog_requests_shed_total Requests rejected with 503',
+            '# TYPE blog_requests_shed_total counter',
+        ]
+        lines += [f'blog_requests_shed_total{{priority="{p}"}} {n}' for p, n in load['shed'].items()]
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain')
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
     """Get platform statistics"""
@@ -258,6 +526,32 @@ def get_posts():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/posts/trending', methods=['GET'])
+def get_trending_posts():
+    """Trending posts (recent views and likes), from Redis only"""
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    
+    try:
+        return jsonify(ranked_posts('trending', request.args.get('category', ''), limit)), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/posts/popular', methods=['GET'])
+def get_popular_posts():
+    """All-time popular posts, from Redis only"""
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    
+    try:
+        return jsonify(ranked_posts('popular', request.args.get('category', ''), limit)), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/posts/<int:post_id>', methods=['GET'])
 def get_post(post_id):
     """Get single post with comments"""
@@ -281,6 +575,8 @@ def get_post(post_id):
         if not post:
             return jsonify({'error': 'Post not found'}), 404
         
+        record_activity(post_id, post['category'], VIEW_WEIGHT, VIEW_WEIGHT, post_summary(post))
+        
         # Get comments
         cur.execute("""
             SELECT c.*, u.username as author
@@ -329,6 +625,10 @@ def create_post():
         cur.close()
         conn.close()
         
+        # Enter the rankings with a zero score
+        record_activity(post['id'], category, 0, 0,
+                        post_summary(dict(post, author=session['username'])))
+        
         return jsonify(dict(post)), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -344,6 +644,22 @@ def add_comment(post_id):
         if not content:
             return jsonify({'error': 'Comment content required'}), 400
         
+        if WRITE_MODE == 'queued':
+            # Hand the write to worker.py, the stream entry id is the provisional id
+            idempotency_key = get_idempotency_key()
+            entry_id = cache.xadd(COMMENT_STREAM, {
+                'post_id': post_id,
+                'user_id': session['user_id'],
+                'content': content,
+                'idempotency_key': scoped_idempotency_key(session['user_id'], idempotency_key)
+            })
+            return jsonify({
+                'id': entry_id,
+                'content': content,
+                'status': 'queued',
+                'idempotency_key': idempotency_key
+            }), 202
+        
         conn = get_db_connection()
         cur = conn.cursor()
         
@@ -387,12 +703,23 @@ def like_post(post_id):
         
         conn.commit()
         
-        cur.execute("SELECT likes FROM posts WHERE id = %s", (post_id,))
+        cur.execute("SELECT likes, category FROM posts WHERE id = %s", (post_id,))
         result = cur.fetchone()
         
         cur.close()
         conn.close()
         
+        if not result:
+            return jsonify({'error': 'Post not found'}), 404
+        
+        if action == 'liked':
+            record_activity(post_id, result['category'], LIKE_WEIGHT, LIKE_WEIGHT)
+        else:
+            # The like being taken back has decayed since, so trending is
+            # left alone; subtracting the full weight would push the post
+            # below posts without any activity
+            record_activity(post_id, result['category'], 0, -LIKE_WEIGHT)
+        
         return jsonify({'action': action, 'likes': result['likes']}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
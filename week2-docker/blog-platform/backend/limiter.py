@@ -0,0 +1,89 @@
+"""
+Adaptive concurrency limiter.
+
+AIMD on observed latency: the limit grows by one slot per "limit"
+fast requests and is cut by BACKOFF when a request is slower than the
+latency target, fails with a database overload error or waited too long
+for a database connection. Other errors (bad input) do not cut it. Requests over the limit are rejected immediately instead
+of queueing.
+
+Each request carries a priority class that may only use a share of the
+limit, so low priority traffic (reads) is shed before critical traffic
+(login) when the backend is saturated.
+"""
+import threading
+import time
+
+# Share of the concurrency limit each priority class may use
+PRIORITY_SHARES = {
+    'critical': 1.0,
+    'write': 0.85,
+    'read': 0.7
+}
+
+
+class AdaptiveLimiter:
+    """Thread-safe AIMD concurrency limiter with priority classes"""
+
+    def __init__(self, initial_limit=20, min_limit=2, max_limit=200,
+                 target_latency=0.25, db_wait_limit=0.1, backoff=0.9,
+                 shares=PRIORITY_SHARES):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.db_wait_limit = db_wait_limit
+        self.backoff = backoff
+        self.shares = shares
+        self.in_flight = 0
+        self.shed = {priority: 0 for priority in shares}
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, priority='read'):
+        """Take a slot for a request, False means shed it"""
+        with self._lock:
+            if self.in_flight >= self._allowed(priority):
+                self.shed[priority] += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, failed=False, priority='read'):
+        """Return a slot and adjust the limit from the request outcome"""
+        with self._lock:
+            # Only grow while the request's class was using all its slots,
+            # otherwise a class with a small share could never raise the limit
+            saturated = self.in_flight >= self._allowed(priority)
+            self.in_flight -= 1
+            if failed or latency > self.target_latency:
+                self._decrease()
+            elif saturated:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def record_db_wait(self, wait):
+        """Feed the time spent waiting for a database connection"""
+        if wait > self.db_wait_limit:
+            with self._lock:
+                self._decrease()
+
+    def snapshot(self):
+        """Current limit, in-flight count and shed counters"""
+        with self._lock:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'shed': dict(self.shed)
+            }
+
+    def _allowed(self, priority):
+        return max(1, int(self.limit * self.shares[priority]))
+
+    def _decrease(self):
+        # One cut per target latency window, so a burst of slow responses
+        # from the same overload does not collapse the limit to the minimum
+        now = time.monotonic()
+        if now - self._last_decrease < self.target_latency:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.backoff)
@@ -0,0 +1,187 @@
+"""
+Overload harness for the adaptive limiter.
+
+Simulates a backend whose database serves CAPACITY queries at a time
+and sends it requests at a fixed rate (open loop, like independent
+users), with and without limiter.AdaptiveLimiter in front. Clients give
+up after --timeout seconds, so responses slower than that are wasted work.
+
+Goodput (useful responses per second) collapses without the limiter once
+the queue grows past the client timeout, and stays near capacity with
+it. Runs without Docker, Postgres or Redis:
+
+    python loadtest.py
+    python loadtest.py --load 0.5 2 8 --duration 5
+    python loadtest.py --errors 0.2 # 20% extra requests failing on bad input
+    python loadtest.py --check      # exit 1 if the limiter misbehaves
+"""
+import argparse
+import queue
+import random
+import sys
+import threading
+import time
+
+from limiter import AdaptiveLimiter
+
+CAPACITY = 4           # concurrent queries the database can serve
+SERVICE_TIME = 0.02    # seconds per query
+MAX_RATE = CAPACITY / SERVICE_TIME
+LOGIN_SHARE = 0.05     # share of requests that are logins, the rest are reads
+
+# --check thresholds
+OVERLOAD = 4.0         # offered load for the goodput check, times capacity
+MIN_GOODPUT = 0.8      # goodput at OVERLOAD with the limiter, share of capacity
+UNDERLOAD = 0.5        # offered load that must not be shed at all
+ERROR_SHARE = 0.2      # share of bad-input requests sent alongside UNDERLOAD
+
+
+class SimulatedBackend:
+    """Requests wait in a FIFO queue for one of CAPACITY database workers"""
+
+    def __init__(self, limiter=None):
+        self.limiter = limiter
+        self.queries = queue.Queue()
+        self.stopped = False
+        for _ in range(CAPACITY):
+            threading.Thread(target=self._db_worker, daemon=True).start()
+
+    def _db_worker(self):
+        while True:
+            done = self.queries.get()
+            if not self.stopped:
+                time.sleep(SERVICE_TIME)
+            done.set()
+
+    def handle(self, priority, bad_input=False):
+        """Serve one request, returns the HTTP status"""
+        if self.limiter and not self.limiter.acquire(priority):
+            return 503
+        start = time.monotonic()
+        if bad_input:
+            # Fails before touching the database (e.g. ?page=x), like the
+            # app this is a 500 that is not an overload signal
+            if self.limiter:
+                self.limiter.release(time.monotonic() - start, failed=False, priority=priority)
+            return 500
+        done = threading.Event()
+        self.queries.put(done)
+        done.wait()
+        if self.limiter:
+            self.limiter.release(time.monotonic() - start, priority=priority)
+        return 200
+
+    def stop(self):
+        """Flush the remaining queue without serving it"""
+        self.stopped = True
+
+
+def run(load, duration, timeout, use_limiter, errors=0.0):
+    """
+    Send load * capacity requests/s with Poisson arrivals, returns the counters.
+    errors is the share of extra bad-input requests sent on top of the load.
+    """
+    limiter = AdaptiveLimiter() if use_limiter else None
+    backend = SimulatedBackend(limiter)
+    stats = {'ok': 0, 'timeout': 0, 'shed': 0, 'failed': 0,
+             'read_ok': 0, 'read_total': 0, 'login_ok': 0, 'login_total': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def request(priority, bad_input):
+        start = time.monotonic()
+        status = backend.handle(priority, bad_input)
+        elapsed = time.monotonic() - start
+        if time.monotonic() > deadline:
+            # Finished after the measurement window
+            return
+        with lock:
+            if status == 500:
+                stats['failed'] += 1
+                return
+            if status == 503:
+                stats['shed'] += 1
+            elif elapsed > timeout:
+                stats['timeout'] += 1
+            else:
+                stats['ok'] += 1
+            kind = 'login' if priority == 'critical' else 'read'
+            stats[kind + '_total'] += 1
+            stats[kind + '_ok'] += status == 200 and elapsed <= timeout
+
+    rate = load * MAX_RATE * (1 + errors)
+    while time.monotonic() < deadline:
+        priority = 'critical' if random.random() < LOGIN_SHARE else 'read'
+        bad_input = random.random() < errors / (1 + errors)
+        threading.Thread(target=request, args=(priority, bad_input), daemon=True).start()
+        time.sleep(random.expovariate(rate))
+
+    backend.stop()
+    stats['goodput'] = stats['ok'] / duration
+    stats['limit'] = limiter.snapshot()['limit'] if limiter else None
+    return stats
+
+
+def success_rate(stats, kind):
+    """Share of requests of a kind answered in time, in percent"""
+    total = stats[kind + '_total']
+    return stats[kind + '_ok'] / total * 100 if total else 0
+
+
+def check(duration, timeout):
+    """
+    Assert goodput holds at OVERLOAD, and nothing is shed at UNDERLOAD
+    even with ERROR_SHARE bad-input requests mixed in.
+    """
+    failures = []
+
+    under = run(UNDERLOAD, duration, timeout, use_limiter=True)
+    if under['shed']:
+        failures.append(f"{under['shed']} requests shed at {UNDERLOAD}x capacity")
+
+    noisy = run(UNDERLOAD, duration, timeout, use_limiter=True, errors=ERROR_SHARE)
+    initial = AdaptiveLimiter().snapshot()['limit']
+    if noisy['shed'] or noisy['limit'] < initial:
+        failures.append(f"{noisy['shed']} requests shed, limit {noisy['limit']} (started at "
+                        f"{initial}) at {UNDERLOAD}x capacity with {ERROR_SHARE:.0%} bad input")
+
+    over = run(OVERLOAD, duration, timeout, use_limiter=True)
+    if over['goodput'] < MIN_GOODPUT * MAX_RATE:
+        failures.append(f"goodput {over['goodput']:.0f}/s at {OVERLOAD}x capacity, "
+                        f"expected at least {MIN_GOODPUT * MAX_RATE:.0f}/s")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print(f"OK: no shedding at {UNDERLOAD}x (with and without {ERROR_SHARE:.0%} bad input), "
+              f"goodput {over['goodput']:.0f}/s at {OVERLOAD}x")
+    return not failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Goodput under overload, with and without the limiter')
+    parser.add_argument('--load', type=float, nargs='+', default=[0.5, 1, 2, 4],
+                        help='offered load, times capacity')
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--timeout', type=float, default=0.5)
+    parser.add_argument('--errors', type=float, default=0.0,
+                        help='share of extra bad-input requests (fast 500s)')
+    parser.add_argument('--check', action='store_true', help='assert instead of printing a table')
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if check(args.duration, args.timeout) else 1)
+
+    print(f"Capacity: {MAX_RATE:.0f} req/s, client timeout {args.timeout}s\n")
+    print(f"{'load':>6} {'limiter':>8} {'goodput/s':>10} {'timeouts':>9} {'shed':>7} "
+          f"{'read ok':>8} {'login ok':>9}")
+    for load in args.load:
+        for use_limiter in (False, True):
+            s = run(load, args.duration, args.timeout, use_limiter, args.errors)
+            print(f"{load:>5}x {'on' if use_limiter else 'off':>8} {s['goodput']:>10.0f} "
+                  f"{s['timeout']:>9} {s['shed']:>7} "
+                  f"{success_rate(s, 'read'):>7.0f}% {success_rate(s, 'login'):>8.0f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""
+Background worker.
+
+Drains the comment stream filled by add_comment when WRITE_MODE=queued and
+writes the comments to PostgreSQL in multi-row INSERT batches. Between
+batches it periodically rebuilds the post rankings from PostgreSQL.
+Run it next to the API: python worker.py
+"""
+import os
+import socket
+import time
+import psycopg2
+from psycopg2.extras import execute_values
+import redis
+
+from app import (cache, get_db_connection, rebuild_rankings,
+                 COMMENT_STREAM, COMMENT_GROUP, COMMENT_DEAD_LETTER)
+
+# Worker Configuration
+CONSUMER_NAME = os.getenv('WORKER_NAME', socket.gethostname())
+BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 100))
+BLOCK_MS = int(os.getenv('WRITE_BLOCK_MS', 1000))
+RETRIES = int(os.getenv('WRITE_RETRIES', 3))
+MAX_DELIVERIES = int(os.getenv('WRITE_MAX_DELIVERIES', 5))
+CLAIM_IDLE_MS = int(os.getenv('WRITE_CLAIM_IDLE_MS', 30000))
+REBUILD_INTERVAL = int(os.getenv('RANKINGS_REBUILD_SECONDS', 3600))
+REBUILD_RETRY = int(os.getenv('RANKINGS_REBUILD_RETRY_SECONDS', 60))
+REBUILD_LOCK = 'rankings:rebuild-lock'
+
+INSERT_COMMENTS = """
+    INSERT INTO comments (post_id, user_id, content, idempotency_key)
+    VALUES %s
+    ON CONFLICT (idempotency_key) DO NOTHING
+"""
+
+def ensure_schema():
+    """
+    Add the idempotency_key column to databases created before queued writes.
+    The init script only runs on an empty volume.
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("ALTER TABLE comments ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64) UNIQUE")
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def ensure_group():
+    """Create the consumer group (and stream) if missing"""
+    try:
+        cache.xgroup_create(COMMENT_STREAM, COMMENT_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+def read_batch():
+    """
+    Next batch of entries.
+    Entries left unacknowledged for CLAIM_IDLE_MS (crashed worker or
+    failed batch) are reclaimed before new entries are read.
+    """
+    claimed = cache.xautoclaim(COMMENT_STREAM, COMMENT_GROUP, CONSUMER_NAME,
+                               min_idle_time=CLAIM_IDLE_MS, count=BATCH_SIZE)[1]
+    if claimed:
+        return drop_exhausted(claimed)
+
+    response = cache.xreadgroup(COMMENT_GROUP, CONSUMER_NAME, {COMMENT_STREAM: '>'},
+                                count=BATCH_SIZE, block=BLOCK_MS)
+    return response[0][1] if response else []
+
+def drop_exhausted(entries):
+    """
+    Dead-letter reclaimed entries that were delivered too many times.
+    Deliveries that failed because PostgreSQL was down are not counted.
+    """
+    # One lookup per id, a range query also returns other consumers' entries
+    pipe = cache.pipeline(transaction=False)
+    for entry_id, _ in entries:
+        pipe.xpending_range(COMMENT_STREAM, COMMENT_GROUP, min=entry_id, max=entry_id, count=1)
+    deliveries = {p['message_id']: p['times_delivered'] for result in pipe.execute() for p in result}
+
+    batch = []
+    for entry_id, fields in entries:
+        if deliveries.get(entry_id, 0) > MAX_DELIVERIES:
+            dead_letter(entry_id, fields, 'max deliveries exceeded')
+        else:
+            batch.append((entry_id, fields))
+    return batch
+
+def dead_letter(entry_id, fields, error):
+    """Move an entry to the dead-letter stream and acknowledge it"""
+    cache.xadd(COMMENT_DEAD_LETTER, dict(fields or {}, source_id=entry_id, error=str(error)[:500]))
+    acknowledge(entry_id)
+
+def acknowledge(*entry_ids):
+    """Acknowledge entries and delete them, so the stream only holds the backlog"""
+    pipe = cache.pipeline()
+    pipe.xack(COMMENT_STREAM, COMMENT_GROUP, *entry_ids)
+    pipe.xdel(COMMENT_STREAM, *entry_ids)
+    pipe.execute()
+
+def insert_comments(conn, entries):
+    """Insert entries in one multi-row statement, duplicates are skipped"""
+    rows = [
+        (int(fields['post_id']), int(fields['user_id']), fields['content'], fields['idempotency_key'])
+        for _, fields in entries
+    ]
+    cur = conn.cursor()
+    execute_values(cur, INSERT_COMMENTS, rows)
+    conn.commit()
+    cur.close()
+
+def write_batch(entries):
+    """
+    Write a batch and acknowledge it.
+    If a row is rejected the batch is replayed row by row so that only
+    the offending entries end up in the dead-letter stream.
+    """
+    conn = get_db_connection()
+    try:
+        try:
+            insert_comments(conn, entries)
+            acknowledge(*[entry_id for entry_id, _ in entries])
+            return
+        except psycopg2.OperationalError:
+            raise
+        except (psycopg2.Error, KeyError, ValueError):
+            conn.rollback()
+
+        for entry_id, fields in entries:
+            try:
+                insert_comments(conn, [(entry_id, fields)])
+                acknowledge(entry_id)
+            except psycopg2.OperationalError:
+                raise
+            except (psycopg2.Error, KeyError, ValueError) as e:
+                conn.rollback()
+                dead_letter(entry_id, fields, e)
+    finally:
+        conn.close()
+
+def process(entries):
+    """Write a batch, retrying with backoff while PostgreSQL is unavailable"""
+    # Entries deleted from the stream come back without fields
+    for entry_id, fields in entries:
+        if not fields:
+            acknowledge(entry_id)
+    entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+    if not entries:
+        return
+
+    for attempt in range(RETRIES):
+        try:
+            write_batch(entries)
+            return
+        except psycopg2.OperationalError as e:
+            print(f"Batch of {len(entries)} failed (attempt {attempt + 1}/{RETRIES}): {e}")
+            time.sleep(2 ** attempt)
+
+    # Still unacknowledged, read_batch reclaims it after CLAIM_IDLE_MS.
+    # Reset the delivery counters so an outage does not push the entries
+    # past MAX_DELIVERIES, only deliveries that reached the database count.
+    cache.xclaim(COMMENT_STREAM, COMMENT_GROUP, CONSUMER_NAME, 0,
+                 [entry_id for entry_id, _ in entries], retrycount=0, justid=True)
+
+def maybe_rebuild_rankings():
+    """Rebuild rankings if no worker did it within REBUILD_INTERVAL"""
+    if not cache.set(REBUILD_LOCK, CONSUMER_NAME, nx=True, ex=REBUILD_INTERVAL):
+        return
+    try:
+        print(f"Rebuilt rankings for {rebuild_rankings()} posts")
+    except Exception as e:
+        # Keep consuming comments and retry after REBUILD_RETRY, not on
+        # every loop while PostgreSQL is struggling
+        print(f"Rankings rebuild failed: {e!r}")
+        cache.set(REBUILD_LOCK, CONSUMER_NAME, ex=REBUILD_RETRY)
+
+def main():
+    ensure_schema()
+    ensure_group()
+    print(f"Worker {CONSUMER_NAME} consuming {COMMENT_STREAM}")
+    while True:
+        try:
+            maybe_rebuild_rankings()
+            entries = read_batch()
+            if entries:
+                process(entries)
+        except redis.ConnectionError as e:
+            print(f"Redis unavailable: {e}")
+            time.sleep(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
-from flask import Flask, render_template_string, request, redirect
+from flask import Flask, render_template_string, request, redirect, Response
 import redis
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import os
+import uuid
+import hashlib
 from datetime import datetime
 
 app = Flask(__name__)
@@ -10,6 +12,14 @@ app = Flask(__name__)
 # Connect to Redis (cache layer)
 cache = redis.Redis(host='redis', port=6379, decode_responses=True)
 
+# Write queue (optional)
+# WRITE_MODE=queued appends signatures to a Redis Stream instead of writing
+# them inside the request; worker.py drains the stream in batches.
+WRITE_MODE = os.getenv('WRITE_MODE', 'direct')
+SIGN_STREAM = 'stream:signatures'
+SIGN_GROUP = 'signature-writers'
+SIGN_DEAD_LETTER = 'stream:signatures:dead'
+
 # PostgreSQL connection function
 def get_db_connection():
     """
@@ -216,6 +226,28 @@ def sign():
     name = request.form.get('name')
     message = request.form.get('message')
     
+    if WRITE_MODE == 'queued':
+        # Validate now, the worker has no way to report errors back
+        if not name:
+            return 'Name is required', 400
+        if len(name) > 100:
+            return 'Name must be at most 100 characters', 400
+        
+        # Queue the write; the stream entry id is the provisional id.
+        # Idempotency-Key makes client retries safe (duplicates are skipped).
+        # The key is hashed with the name, so two visitors sending the same
+        # key do not drop each other's signature
+        idempotency_key = request.headers.get('Idempotency-Key', '').strip() or uuid.uuid4().hex
+        idempotency_key = hashlib.sha256(f"{name}:{idempotency_key}".encode('utf-8')).hexdigest()
+        fields = {'name': name, 'idempotency_key': idempotency_key}
+        if message is not None:
+            # Streams cannot hold None, a missing field is written as NULL
+            fields['message'] = message
+        entry_id = cache.xadd(SIGN_STREAM, fields)
+        response = redirect('/')
+        response.headers['X-Provisional-Id'] = entry_id
+        return response
+    
     # Insert into PostgreSQL
     conn = get_db_connection()
     cur = conn.cursor()
@@ -250,5 +282,42 @@ def health():
     except Exception as e:
         return {'status': 'unhealthy', 'error': str(e)}, 500
 
+@app.route('/metrics')
+def metrics():
+    """
+    Prometheus metrics endpoint.
+    Exposes write queue depth and consumer lag.
+    """
+    length, lag, pending, dead_letters = 0, 0, 0, 0
+    try:
+        length = cache.xlen(SIGN_STREAM)
+        dead_letters = cache.xlen(SIGN_DEAD_LETTER)
+        for group in cache.xinfo_groups(SIGN_STREAM):
+            if group['name'] == SIGN_GROUP:
+                # 'lag' needs Redis 7+, older servers only report pending
+                lag = group.get('lag') if group.get('lag') is not None else length
+                pending = group['pending']
+    except redis.ResponseError:
+        # Stream not created yet (no queued writes so far)
+        pass
+    except Exception as e:
+        return {'error': str(e)}, 500
+    
+    lines = [
+        '# HELP guestbook_write_queue_length Signatures queued and not yet written',
+        '# TYPE guestbook_write_queue_length gauge',
+        f'guestbook_write_queue_length {length}',
+        '# HELP guestbook_write_queue_lag Entries not yet delivered to the worker',
+        '# TYPE guestbook_write_queue_lag gauge',
+        f'guestbook_write_queue_lag {lag}',
+        '# HELP guestbook_write_queue_pending Entries delivered but not acknowledged',
+        '# TYPE guestbook_write_queue_pending gauge',
+        f'guestbook_write_queue_pending {pending}',
+        '# HELP guestbook_write_queue_dead_letters Entries moved to the dead-letter stream',
+        '# TYPE guestbook_write_queue_dead_letters gauge',
+        f'guestbook_write_queue_dead_letters {dead_letters}',
+    ]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain')
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -3,6 +3,7 @@ CREATE TABLE IF NOT EXISTS visitors (
     id SERIAL PRIMARY KEY,              -- Auto-incrementing ID
     name VARCHAR(100) NOT NULL,          -- Visitor name (max 100 chars)
     message TEXT,                        -- Their message (unlimited length)
+    idempotency_key VARCHAR(64) UNIQUE,  -- Dedup key for queued writes
     timestamp TIMESTAMP DEFAULT NOW()    -- When they visited (auto-filled)
 );
 
@@ -0,0 +1,184 @@
+"""
+Guestbook write worker.
+
+Drains the signature stream filled by /sign when WRITE_MODE=queued.
+Signatures are written with one multi-row INSERT per batch and the
+recent_visitors cache is invalidated once per batch instead of once
+per signature.
+"""
+import os
+import socket
+import time
+import psycopg2
+from psycopg2.extras import execute_values
+import redis
+
+from app import cache, get_db_connection, SIGN_STREAM, SIGN_GROUP, SIGN_DEAD_LETTER
+
+# Worker settings (environment-based, like the web app)
+CONSUMER_NAME = os.getenv('WORKER_NAME', socket.gethostname())
+BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 100))
+BLOCK_MS = int(os.getenv('WRITE_BLOCK_MS', 1000))
+RETRIES = int(os.getenv('WRITE_RETRIES', 3))
+MAX_DELIVERIES = int(os.getenv('WRITE_MAX_DELIVERIES', 5))
+CLAIM_IDLE_MS = int(os.getenv('WRITE_CLAIM_IDLE_MS', 30000))
+
+INSERT_VISITORS = '''
+    INSERT INTO visitors (name, message, idempotency_key)
+    VALUES %s
+    ON CONFLICT (idempotency_key) DO NOTHING
+'''
+
+def ensure_schema():
+    """
+    Add the idempotency_key column to databases created before queued writes.
+    The init script only runs on an empty volume.
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("ALTER TABLE visitors ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64) UNIQUE")
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def ensure_group():
+    """
+    Create the consumer group.
+    MKSTREAM creates the stream too if nobody signed yet.
+    """
+    try:
+        cache.xgroup_create(SIGN_STREAM, SIGN_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+def read_batch():
+    """
+    Get the next batch of signatures.
+    Entries nobody acknowledged for CLAIM_IDLE_MS (crashed worker or
+    failed batch) are reclaimed first, then new entries are read.
+    """
+    claimed = cache.xautoclaim(SIGN_STREAM, SIGN_GROUP, CONSUMER_NAME,
+                               min_idle_time=CLAIM_IDLE_MS, count=BATCH_SIZE)[1]
+    if claimed:
+        return drop_exhausted(claimed)
+
+    response = cache.xreadgroup(SIGN_GROUP, CONSUMER_NAME, {SIGN_STREAM: '>'},
+                                count=BATCH_SIZE, block=BLOCK_MS)
+    return response[0][1] if response else []
+
+def drop_exhausted(entries):
+    """
+    Dead-letter reclaimed entries delivered more than MAX_DELIVERIES times.
+    Stops a signature that can never be written from blocking the queue.
+    Deliveries that failed because PostgreSQL was down are not counted.
+    """
+    # One lookup per id, a range query also returns other consumers' entries
+    pipe = cache.pipeline(transaction=False)
+    for entry_id, _ in entries:
+        pipe.xpending_range(SIGN_STREAM, SIGN_GROUP, min=entry_id, max=entry_id, count=1)
+    deliveries = {p['message_id']: p['times_delivered'] for result in pipe.execute() for p in result}
+
+    batch = []
+    for entry_id, fields in entries:
+        if deliveries.get(entry_id, 0) > MAX_DELIVERIES:
+            dead_letter(entry_id, fields, 'max deliveries exceeded')
+        else:
+            batch.append((entry_id, fields))
+    return batch
+
+def dead_letter(entry_id, fields, error):
+    """Move an entry to the dead-letter stream and acknowledge it."""
+    cache.xadd(SIGN_DEAD_LETTER, dict(fields or {}, source_id=entry_id, error=str(error)[:500]))
+    acknowledge(entry_id)
+
+def acknowledge(*entry_ids):
+    """Acknowledge entries and delete them, so the stream only holds the backlog"""
+    pipe = cache.pipeline()
+    pipe.xack(SIGN_STREAM, SIGN_GROUP, *entry_ids)
+    pipe.xdel(SIGN_STREAM, *entry_ids)
+    pipe.execute()
+
+def insert_visitors(conn, entries):
+    """
+    Insert signatures with a single multi-row INSERT.
+    Entries already written (same idempotency key) are skipped.
+    """
+    rows = [(fields['name'], fields.get('message'), fields['idempotency_key']) for _, fields in entries]
+    cur = conn.cursor()
+    execute_values(cur, INSERT_VISITORS, rows)
+    conn.commit()
+    cur.close()
+
+def write_batch(entries):
+    """
+    Write and acknowledge a batch.
+    If PostgreSQL rejects a row the batch is replayed one row at a time,
+    so only the bad entries go to the dead-letter stream.
+    """
+    conn = get_db_connection()
+    try:
+        try:
+            insert_visitors(conn, entries)
+            acknowledge(*[entry_id for entry_id, _ in entries])
+            return
+        except psycopg2.OperationalError:
+            raise
+        except (psycopg2.Error, KeyError):
+            conn.rollback()
+
+        for entry_id, fields in entries:
+            try:
+                insert_visitors(conn, [(entry_id, fields)])
+                acknowledge(entry_id)
+            except psycopg2.OperationalError:
+                raise
+            except (psycopg2.Error, KeyError) as e:
+                conn.rollback()
+                dead_letter(entry_id, fields, e)
+    finally:
+        conn.close()
+
+def process(entries):
+    """
+    Write a batch, retrying with backoff while PostgreSQL is down.
+    The cache is invalidated once for the whole batch.
+    """
+    # Entries deleted from the stream come back without fields
+    for entry_id, fields in entries:
+        if not fields:
+            acknowledge(entry_id)
+    entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+    if not entries:
+        return
+
+    for attempt in range(RETRIES):
+        try:
+            write_batch(entries)
+            cache.delete('recent_visitors')
+            return
+        except psycopg2.OperationalError as e:
+            print(f"Batch of {len(entries)} failed (attempt {attempt + 1}/{RETRIES}): {e}")
+            time.sleep(2 ** attempt)
+
+    # Still unacknowledged, read_batch reclaims it after CLAIM_IDLE_MS.
+    # Reset the delivery counters so an outage does not push the entries
+    # past MAX_DELIVERIES, only deliveries that reached the database count.
+    cache.xclaim(SIGN_STREAM, SIGN_GROUP, CONSUMER_NAME, 0,
+                 [entry_id for entry_id, _ in entries], retrycount=0, justid=True)
+
+def main():
+    ensure_schema()
+    ensure_group()
+    print(f"Worker {CONSUMER_NAME} consuming {SIGN_STREAM}")
+    while True:
+        try:
+            entries = read_batch()
+            if entries:
+                process(entries)
+        except redis.ConnectionError as e:
+            print(f"Redis unavailable: {e}")
+            time.sleep(1)
+
+if __name__ == '__main__':
+    main()